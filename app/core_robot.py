@@ -1,19 +1,27 @@
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError, Error as PWError
-import os, sys, contextlib
-from app.robot_utils import log, core_search, BASE_URL
+import os, sys
+from app.robot_utils import log, core_search, open_page, setup_logging, BASE_URL, BLOCK_ASSETS
+from app import skill_cache
 
 TARGET_URL = os.getenv("TARGET_URL", BASE_URL)
 SEARCH_QUERY = os.getenv("SEARCH_QUERY", "311")
 HEADFUL = os.getenv("HEADFUL", "0") == "1"
 
 def run():
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=not HEADFUL, args=["--no-sandbox"])
-        ctx = browser.new_context()
-        page = ctx.new_page()
+    setup_logging("robot")
+    hit = skill_cache.try_execute(SEARCH_QUERY, TARGET_URL)
+    if hit:
+        title, href, mode = hit
+        log(f"search mode: {mode}")
+        print(f"Success! Query='{SEARCH_QUERY}' | First result: {title} | URL: {href}")
+        return 0
+
+    with sync_playwright() as p, open_page(p, headful=HEADFUL) as page:
         try:
             log("goto homepage")
-            page.goto(TARGET_URL, timeout=20000, wait_until="domcontentloaded")
+            # With assets blocked there is no banner probe, so commit is enough; otherwise
+            # dismiss_banners probes the document once, right away, and needs it parsed
+            page.goto(TARGET_URL, timeout=20000, wait_until="commit" if BLOCK_ASSETS else "domcontentloaded")
 
             title, href, mode = core_search(page, SEARCH_QUERY)
             log(f"search mode: {mode}")
@@ -21,6 +29,7 @@ def run():
                 print(f"Failure: no results found for '{SEARCH_QUERY}'")
                 return 1
 
+            skill_cache.learn(page.url, SEARCH_QUERY, href, TARGET_URL)
             print(f"Success! Query='{SEARCH_QUERY}' | First result: {title} | URL: {href}")
             return 0
 
@@ -33,11 +42,6 @@ def run():
         except (PWError, Exception) as e:
             print(f"Failure: unexpected error: {e}")
             return 3
-        finally:
-            with contextlib.suppress(Exception):
-                ctx.close()
-            with contextlib.suppress(Exception):
-                browser.close()
 
 if __name__ == "__main__":
     sys.exit(run())
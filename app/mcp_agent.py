@@ -1,31 +1,91 @@
 from __future__ import annotations
-import os, json, re, time, contextlib, asyncio
-from typing import Any, Dict, List
+import os, re, time, asyncio, hashlib, threading, contextlib, logging
+import orjson
+import httpx
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit, urljoin
 from openai import OpenAI
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError, Error as PWError
 from mcp import ClientSession
 from mcp.client.sse import sse_client
-from app.robot_utils import core_search, BASE_URL
+from app.robot_utils import core_search, open_page, setup_logging, BASE_URL, CACHE_DIR
+from app import skill_cache
 
 GOAL = os.getenv("GOAL", "Open https://lacity.gov, search for 311, and report the first result title and URL.")
 MCP_URL = os.getenv("MCP_SERVER_URL", "http://localhost:11000/sse")
 MODEL = os.getenv("MODEL", "gpt-4o-mini")
 HEADFUL = os.getenv("HEADFUL", "0") == "1"
 SEARCH_QUERY = os.getenv("SEARCH_QUERY", "311")
+PLAN_CACHE_DIR = os.path.join(CACHE_DIR, "plans")
 
-ALLOWED_ACTIONS = {"navigate", "click", "type", "wait", "extract_text"}
+ALLOWED_ACTIONS = frozenset({"navigate", "click", "type", "wait", "extract_text"})
 
-def log(msg: str): print(f"[agent] {msg}", flush=True)
+def _selector_step(action: str):
+    return lambda val, st: {"action": action, "selector": val}
+
+# Shorthand {"<action>": value, ...} -> structured step
+_HANDLERS = {
+    "navigate": lambda val, st: {"action": "navigate", "url": val},
+    "click": _selector_step("click"),
+    "wait": _selector_step("wait"),
+    "extract_text": _selector_step("extract_text"),
+    "type": lambda val, st: {"action": "type", "selector": val, **({"text": st["text"]} if "text" in st else {})},
+}
+
+_RE_FENCE = re.compile(r"```(?:json)?\s*([\s\S]*?)```")
+_RE_JSON_OBJ = re.compile(r"(\{[\s\S]*\}|\[[\s\S]*\])")
+
+# Fused type -> submit -> wait -> extract tail, run as one evaluate. Answers {unsupported: true}
+# before any side effect when a selector is not plain CSS, the input is missing, or it has no
+# form to submit (a synthetic Enter keydown is untrusted and would never submit); answers
+# {unsupported: true} too if validation blocks the submit. A submit nobody preventDefault()s is
+# a real navigation: answer {navigating: true} and let the caller wait on the new document.
+# Otherwise only elements added after the submit count, so the pre-submit page is never read.
+FUSED_SEARCH_JS = """async ({typeSel, text, waitSel, outSel, timeout}) => {
+  try { [typeSel, waitSel, outSel].forEach(s => document.querySelector(s)); }
+  catch (e) { return {unsupported: true}; }
+  const i = document.querySelector(typeSel);
+  if (!i || !i.form) return {unsupported: true};
+  const seenWait = new Set(document.querySelectorAll(waitSel));
+  const seenOut = new Set(document.querySelectorAll(outSel));
+  const fresh = (sel, seen) => [...document.querySelectorAll(sel)].find(el => !seen.has(el));
+  i.focus(); i.value = text;
+  i.dispatchEvent(new Event('input', {bubbles: true}));
+  let prevented = null;
+  const onSubmit = e => { prevented = e.defaultPrevented; };
+  window.addEventListener('submit', onSubmit);  // bubble phase on window: after the page's handlers
+  try { i.form.requestSubmit(); } finally { window.removeEventListener('submit', onSubmit); }
+  if (prevented === null) return {unsupported: true};
+  if (!prevented) return {navigating: true};
+  await new Promise((resolve, reject) => {
+    const mo = new MutationObserver(() => {
+      if (fresh(waitSel, seenWait)) { mo.disconnect(); resolve(); }
+    });
+    mo.observe(document.body, {subtree: true, childList: true});
+    setTimeout(() => { mo.disconnect(); reject(new Error(`timeout waiting for ${waitSel}`)); }, timeout);
+  });
+  const a = fresh(outSel, seenOut);
+  if (!a) throw new Error(`no new match for ${outSel}`);
+  return {title: (a.innerText || '').trim(), url: a.getAttribute('href') || ''};
+}"""
+
+_log = logging.getLogger("agent")
+
+def log(msg: str): _log.info(msg)
+
+def absolute_url(page, href: str) -> str:
+    # Relative to the document the link came from, not the site root
+    return urljoin(page.url, href) if href else href
 
 def extract_json_block(s: str) -> str:
-    m = re.search(r"```(?:json)?\s*([\s\S]*?)```", s); return m.group(1).strip() if m else s
+    m = _RE_FENCE.search(s); return m.group(1).strip() if m else s
 
 def parse_json_maybe(s: str) -> Any:
     s = extract_json_block(s).strip()
-    try: return json.loads(s)
+    try: return orjson.loads(s)
     except Exception:
-        m = re.search(r"(\{[\s\S]*\}|\[[\s\S]*\])", s); 
-        return json.loads(m.group(1)) if m else (_ for _ in ()).throw(ValueError("no json"))
+        m = _RE_JSON_OBJ.search(s)
+        return orjson.loads(m.group(1)) if m else (_ for _ in ()).throw(ValueError("no json"))
 
 def normalize_plan(raw: Any) -> List[Dict[str, Any]]:
     steps = raw.get("steps") if isinstance(raw, dict) else raw
@@ -43,23 +103,15 @@ def normalize_plan(raw: Any) -> List[Dict[str, Any]]:
             continue
 
         # Case 2: shorthand format from the LLM (like {"navigate": "https://..."})
-        for key, val in st.items():
-            if key in ALLOWED_ACTIONS:
-                step = {"action": key}
-                if key == "navigate":
-                    step["url"] = val
-                elif key in ("click", "wait", "extract_text"):
-                    step["selector"] = val
-                elif key == "type":
-                    step["selector"] = val
-                    if "text" in st:
-                        step["text"] = st["text"]
-                # Preserve any extra keys
-                for k2, v2 in st.items():
-                    if k2 not in step:
-                        step[k2] = v2
-                out.append(step)
-                break
+        hit = ALLOWED_ACTIONS & st.keys()
+        if not hit:
+            continue
+        # Several action keys: the first one in the step wins
+        key = next(iter(hit)) if len(hit) == 1 else next(k for k in st if k in hit)
+        step = _HANDLERS[key](st[key], st)
+        # Preserve any extra keys
+        step.update({k: v for k, v in st.items() if k not in step})
+        out.append(step)
 
     if not out:
         raise ValueError("no valid steps after normalization")
@@ -67,9 +119,14 @@ def normalize_plan(raw: Any) -> List[Dict[str, Any]]:
 
 
 def fallback_execute(page) -> Dict[str, Any]:
-    title, href, mode = core_search(page, SEARCH_QUERY)
-    if not title:
-        raise RuntimeError(f"no results for '{SEARCH_QUERY}'")
+    hit = skill_cache.try_execute(SEARCH_QUERY, BASE_URL)
+    if hit:
+        title, href, mode = hit
+    else:
+        title, href, mode = core_search(page, SEARCH_QUERY)
+        if not title:
+            raise RuntimeError(f"no results for '{SEARCH_QUERY}'")
+        skill_cache.learn(page.url, SEARCH_QUERY, href, BASE_URL)
     return {"first_result": {"title": title, "url": href}, "_mode": f"fallback_core_{mode}"}
 
 def normalize_call_tool_result(res) -> dict:
@@ -91,25 +148,147 @@ def normalize_call_tool_result(res) -> dict:
     except Exception:
         return {"raw": str(res)}
 
-async def mcp_snapshot() -> Dict[str, Any]:
+class SnapshotClient:
+    """MCP session held open on a background event loop for the whole agent run.
+
+    The SSE connection and initialize() handshake are paid once; snapshot() and
+    call() are thread-safe and reuse the session. Connect failures are reported
+    by snapshot() rather than raised, matching the one-shot behaviour.
+    """
+
+    def __init__(self, url: str = MCP_URL, connect_timeout: float = 15.0):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.session: Optional[ClientSession] = None
+        self.error: Optional[str] = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="mcp-client", daemon=True)
+        self._ready = threading.Event()
+        self._stop: Optional[asyncio.Event] = None
+        self._serve_future = None
+
+    async def _serve(self) -> None:
+        # The SSE/session contexts must be entered and exited by the same task
+        self._stop = asyncio.Event()
+        try:
+            async with sse_client(url=self.url) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.session = None
+            self._ready.set()
+
+    def _run(self, coro, timeout: float = 30.0):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def __enter__(self) -> "SnapshotClient":
+        self._thread.start()
+        self._serve_future = asyncio.run_coroutine_threadsafe(self._serve(), self._loop)
+        if not self._ready.wait(self.connect_timeout):
+            self.error = f"connect timed out after {self.connect_timeout}s"
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        with contextlib.suppress(Exception):
+            self._serve_future.result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+        if not self._thread.is_alive():
+            self._loop.close()
+
+    async def _snapshot(self, session: ClientSession) -> Dict[str, Any]:
+        # Probe all candidate tools concurrently. Return as soon as the highest-priority probe
+        # still in the running succeeds, so a slow rejection never delays a good result.
+        names = ("snapshot", "get_accessibility_tree", "a11y_tree")
+        tasks = {asyncio.ensure_future(session.call_tool(n, {})): rank for rank, n in enumerate(names)}
+        outcome: Dict[int, Any] = {}  # rank -> result, or None if unusable
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    ok = not t.cancelled() and t.exception() is None and not getattr(t.result(), "isError", False)
+                    outcome[tasks[t]] = t.result() if ok else None
+                for rank in range(len(names)):
+                    if rank not in outcome:
+                        break  # a higher-priority probe is still running
+                    if outcome[rank] is not None:
+                        return normalize_call_tool_result(outcome[rank])
+        finally:
+            for t in pending:
+                t.cancel()
+        tools_resp = await session.list_tools()
+        tools = [t.name for t in getattr(tools_resp, "tools", [])]
+        return {"note": "no_snapshot_tool_found", "tools": tools}
+
+    def snapshot(self) -> Dict[str, Any]:
+        session = self.session
+        if session is None:
+            return {"note": "mcp_connect_error", "error": self.error or "not connected", "url": self.url}
+        try:
+            return self._run(self._snapshot(session))
+        except Exception as e:
+            return {"note": "mcp_call_error", "error": str(e), "url": self.url}
+
+    def call(self, name: str, args: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        session = self.session
+        if session is None:
+            raise RuntimeError(f"MCP not connected: {self.error}")
+        return normalize_call_tool_result(self._run(session.call_tool(name, args or {})))
+
+def plan_cache_path(snapshot: Dict[str, Any], goal: str) -> str:
+    # Deliberately coarse: goal + target host + snapshot status, so cosmetic page changes still
+    # hit. Tool names are not part of it; a successful snapshot does not list them.
+    fingerprint = {
+        "host": urlsplit(BASE_URL).hostname,
+        "note": snapshot.get("note", "ok"),
+    }
+    key = hashlib.blake2b(goal.encode() + orjson.dumps(fingerprint, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+    return os.path.join(PLAN_CACHE_DIR, f"{key}.json")
+
+def load_cached_plan(snapshot: Dict[str, Any], goal: str) -> Optional[List[Dict[str, Any]]]:
     try:
-        async with sse_client(url=MCP_URL) as (read, write):
-            async with ClientSession(read, write) as session:
-                await session.initialize()
-                for tool_name in ("snapshot", "get_accessibility_tree", "a11y_tree"):
-                    try:
-                        res = await session.call_tool(tool_name, {}); return normalize_call_tool_result(res)
-                    except Exception:
-                        continue
-                tools_resp = await session.list_tools()
-                tools = [t.name for t in getattr(tools_resp, "tools", [])]
-                return {"note": "no_snapshot_tool_found", "tools": tools}
-    except Exception as e:
-        return {"note": "mcp_connect_error", "error": str(e), "url": MCP_URL}
+        with open(plan_cache_path(snapshot, goal), "rb") as f:
+            return normalize_plan(orjson.loads(f.read()))
+    except (OSError, ValueError):
+        return None
+
+def save_cached_plan(snapshot: Dict[str, Any], goal: str, plan: List[Dict[str, Any]]) -> None:
+    try:
+        os.makedirs(PLAN_CACHE_DIR, exist_ok=True)
+        with open(plan_cache_path(snapshot, goal), "wb") as f:
+            f.write(orjson.dumps(plan))
+    except OSError as e:
+        log(f"plan not cached ({e})")
+
+_OPENAI: Optional[OpenAI] = None
+
+def openai_client() -> OpenAI:
+    """Shared client: one pooled HTTP/2 connection reused across LLM calls."""
+    global _OPENAI
+    if _OPENAI is None:
+        _OPENAI = OpenAI(http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=4),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        ))
+    return _OPENAI
+
+def drop_cached_plan(snapshot: Dict[str, Any], goal: str) -> None:
+    # A cached plan that failed would otherwise pin this fingerprint to the fallback forever
+    with contextlib.suppress(OSError):
+        os.remove(plan_cache_path(snapshot, goal))
 
 def ask_llm_for_plan(snapshot: Dict[str, Any], goal: str) -> List[Dict[str, Any]]:
     if not os.getenv("OPENAI_API_KEY"): raise RuntimeError("no api key")
-    client = OpenAI()
+    client = openai_client()
     system = (
         "Return ONLY a JSON array of steps, or {\"steps\":[...]}. "
         "Each step MUST include an 'action' field. "
@@ -117,7 +296,7 @@ def ask_llm_for_plan(snapshot: Dict[str, Any], goal: str) -> List[Dict[str, Any]
         "Avoid using 'input[name=q]' unless it exists in the snapshot. "
         "Allowed actions: navigate{url}, click{selector|text|role+name}, type{selector,text}, wait{selector}, extract_text{selector,key}."
     )
-    user = json.dumps({"goal": goal, "page": snapshot}, ensure_ascii=False)
+    user = orjson.dumps({"goal": goal, "page": snapshot}, option=orjson.OPT_NON_STR_KEYS).decode()
     resp = client.chat.completions.create(
         model=MODEL,
         messages=[{"role":"system","content":system},{"role":"user","content":user}],
@@ -125,13 +304,13 @@ def ask_llm_for_plan(snapshot: Dict[str, Any], goal: str) -> List[Dict[str, Any]
     )
     content = resp.choices[0].message.content or "[]"
     raw = parse_json_maybe(content)
-    log(f"LLM raw content: {content[:400]}")  # show first 400 chars
+    _log.debug("LLM raw content: %s", content[:400])  # show first 400 chars
     return normalize_plan(raw)
 
 def exec_step(page, step: Dict[str, Any], results: Dict[str, Any]) -> None:
     a = step.get("action")
     if a == "navigate":
-        page.goto(step["url"], timeout=20000, wait_until="domcontentloaded")
+        page.goto(step["url"], timeout=20000, wait_until="commit")
     elif a == "click":
         if "selector" in step:
             page.wait_for_selector(step["selector"], timeout=8000); page.click(step["selector"], timeout=8000)
@@ -152,36 +331,95 @@ def exec_step(page, step: Dict[str, Any], results: Dict[str, Any]) -> None:
         loc = page.locator(step["selector"]).first
         title = (loc.inner_text() or "").strip()
         href = loc.get_attribute("href") or ""
-        if href and href.startswith("/"): href = BASE_URL + href.lstrip("/")
-        results[step.get("key", "value")] = {"title": title, "url": href}
+        results[step.get("key", "value")] = {"title": title, "url": absolute_url(page, href)}
     else:
         raise ValueError(f"unknown action: {a}")
 
+def fuse_plan(plan: List[Dict[str, Any]]):
+    """Split off a trailing [type, wait, extract_text] that can run as one evaluate.
+       Returns (prefix_steps, fused_or_None)."""
+    tail = plan[-3:]
+    if [st.get("action") for st in tail] != ["type", "wait", "extract_text"]:
+        return plan, None
+    typ, wait, extract = tail
+    # Only fuse what exec_step would submit itself (it presses Enter for search inputs)
+    if "search" not in typ.get("selector", "") or "text" not in typ:
+        return plan, None
+    if not wait.get("selector") or not extract.get("selector"):
+        return plan, None
+    args = {
+        "typeSel": typ["selector"],
+        "text": typ["text"],
+        "waitSel": wait["selector"],
+        "outSel": extract["selector"],
+        "timeout": 12000,
+    }
+    return plan[:-3], {"steps": tail, "args": args}
+
+def _is_navigation_error(e: PWError) -> bool:
+    # Playwright: "Execution context was destroyed, most likely because of a navigation"
+    return "Execution context was destroyed" in str(e)
+
+def exec_fused(page, fused: Dict[str, Any], results: Dict[str, Any]) -> None:
+    steps = fused["steps"]
+    # After a commit-only navigate the input is usually not parsed yet
+    page.wait_for_selector(fused["args"]["typeSel"], timeout=8000)
+    try:
+        out = page.evaluate(FUSED_SEARCH_JS, fused["args"])
+    except PWError as e:
+        if _is_navigation_error(e):
+            # The submit navigated and destroyed the context: typing is done, finish step by step
+            log("fused tail navigated; continuing stepwise")
+            tail = steps[1:]
+        else:
+            log(f"fused tail failed ({e.__class__.__name__}: {e}); re-running stepwise")
+            tail = steps
+        for step in tail:
+            exec_step(page, step, results)
+        return
+    if out.get("navigating"):
+        # Real form navigation: typing is done, the new document is waited on step by step
+        log("fused tail navigated; continuing stepwise")
+        for step in steps[1:]:
+            exec_step(page, step, results)
+        return
+    if out.get("unsupported"):
+        for step in steps:
+            exec_step(page, step, results)
+        return
+    results[steps[-1].get("key", "value")] = {"title": out["title"], "url": absolute_url(page, out["url"])}
+
 def main() -> int:
+    setup_logging("robot", "agent")
     try:
-        snapshot = asyncio.run(mcp_snapshot())
-        log(f"snapshot status: {snapshot.get('note','ok')}")
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=not HEADFUL, args=["--no-sandbox"])
-            ctx = browser.new_context()
-            page = ctx.new_page()
+        with SnapshotClient() as mcp, sync_playwright() as p, open_page(p, headful=HEADFUL) as page:
+            snapshot = mcp.snapshot()
+            log(f"snapshot status: {snapshot.get('note','ok')}")
             results: Dict[str, Any] = {}
+            cached = load_cached_plan(snapshot, GOAL)
             try:
-                try:
+                if cached:
+                    plan = cached
+                    log(f"plan cache hit ({len(plan)} steps)")
+                else:
                     plan = ask_llm_for_plan(snapshot, GOAL)
                     log(f"AI plan accepted ({len(plan)} steps)")
-                    for step in plan:
-                        exec_step(page, step, results)
-                    results["_mode"] = "ai_plan"
-                except Exception as e:
-                    log(f"Falling back to core helpers ({e.__class__.__name__}: {e})")
-                    results = fallback_execute(page)
-                    results["_mode"] = "fallback_core"
-                print("Success! Results:", json.dumps(results, ensure_ascii=False))
-                return 0
-            finally:
-                with contextlib.suppress(Exception): ctx.close()
-                with contextlib.suppress(Exception): browser.close()
+                prefix, fused = fuse_plan(plan)
+                for step in prefix:
+                    exec_step(page, step, results)
+                if fused:
+                    exec_fused(page, fused, results)
+                results["_mode"] = "ai_plan"
+                if not cached:
+                    save_cached_plan(snapshot, GOAL, plan)
+            except Exception as e:
+                log(f"Falling back to core helpers ({e.__class__.__name__}: {e})")
+                if cached:
+                    drop_cached_plan(snapshot, GOAL)
+                results = fallback_execute(page)
+                results["_mode"] = "fallback_core"
+            print("Success! Results:", orjson.dumps(results).decode())
+            return 0
     except PWTimeoutError as e:
         print(f"Failure: timeout: {e}"); return 2
     except KeyboardInterrupt:
@@ -1,13 +1,243 @@
 from __future__ import annotations
-from playwright.sync_api import TimeoutError as PWTimeoutError
-from tenacity import retry, stop_after_attempt, wait_fixed
-import re, contextlib
+from playwright.sync_api import TimeoutError as PWTimeoutError, Error as PWError
+from selectolax.parser import HTMLParser
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
+import os, re, contextlib, weakref, logging, logging.handlers
+from urllib.parse import urljoin
 
 BASE_URL = "https://lacity.gov/"
+CACHE_DIR = os.path.expanduser(os.getenv("ROBOT_CACHE_DIR", "~/.cache/playwright-robot"))
 
-def log(msg: str): print(f"[robot] {msg}", flush=True)
+# Organic result anchors, most specific first (Google CSE, then Drupal search)
+ORGANIC_SELECTORS = (
+    "div.gsc-results .gsc-webResult a.gs-title",
+    "div.gsc-results .gs-title a",
+    ".search-results .search-result h3 a",
+    "main article h3 a",
+    "main h3 a[href]",
+)
 
-@retry(stop=stop_after_attempt(2), wait=wait_fixed(0.8))
+# [selector, limit] pairs scanned in order; the last entry is the any-link-in-main fallback
+ORGANIC_CANDIDATES = [[sel, 20] for sel in ORGANIC_SELECTORS] + [["main a[href]:not([href^='#'])", 40]]
+ORGANIC_UNION = ", ".join(sel for sel, _ in ORGANIC_CANDIDATES)
+# "dom": one evaluate_all over the candidate anchors (default, no full-DOM transfer);
+# "html": one page.content() parsed with selectolax, cheaper when the DOM is small
+ORGANIC_SOURCE = os.getenv("ORGANIC_SOURCE", "dom")
+
+# [rank, title, href] per anchor. Each candidate's cap counts all of its own matches, as a
+# per-selector scan would; rank is the first candidate whose cap still covered the anchor.
+ORGANIC_ROWS_JS = """(els, cands) => {
+  const seen = cands.map(() => 0), out = [];
+  for (const a of els) {
+    let rank = -1;
+    cands.forEach(([s, limit], r) => {
+      if (a.matches(s) && seen[r]++ < limit && rank < 0) rank = r;
+    });
+    if (rank >= 0) out.push([rank, (a.innerText || '').trim(), (a.getAttribute('href') || '').trim()]);
+  }
+  return out;
+}"""
+
+ALL_LA_RE = re.compile(r"\bAll LA City Websites\b", re.I)
+SEARCH_BUTTON_NAME_RE = re.compile(r"^search$", re.I)
+
+SEARCH_INPUT_SELECTORS = (
+    "form[role='search'] input[type='search']",
+    "form[role='search'] input[name='keys']",
+    "form[role='search'] input[name='q']",
+    "input[type='search']",
+    "input[name='keys']",
+    "input[name='q']",
+    "input[aria-label*='Search' i]",
+)
+
+RESULT_SELECTORS = (
+    "main article h3 a",
+    "main .search-results a",
+    "article h2 a",
+    "main a.search-result__link",
+    "main li a[href]:not([href^='#'])",
+)
+RESULT_UNION = ", ".join(RESULT_SELECTORS)
+
+# Index (in document order) of the first visible element from the highest-priority selector, or -1
+BEST_MATCH_JS = """(els, sels) => {
+  let best = -1, rank = Infinity;
+  els.forEach((el, i) => {
+    const r = sels.findIndex(s => el.matches(s));
+    if (r < rank && (el.offsetWidth || el.offsetHeight || el.getClientRects().length)) { rank = r; best = i; }
+  });
+  return best;
+}"""
+
+# Resolves as soon as we are on a search URL and any results container has rendered
+RESULTS_READY_JS = """(sels) => location.href.includes('search') && sels.some(s => document.querySelector(s))"""
+RESULTS_READY_SELECTORS = [
+    "div.gsc-results .gsc-webResult",
+    ".search-results .search-result",
+    "main article h3 a",
+]
+
+# Consent buttons; the text entries mirror Playwright's case-insensitive :has-text()
+BANNER_BUTTON_TEXTS = ("Accept", "I Agree")
+BANNER_CSS = (
+    "[aria-label*='Accept']",
+    "#onetrust-accept-btn-handler",
+    "[data-testid='cookie-accept']",
+)
+BANNER_PROBE_ARGS = {"texts": list(BANNER_BUTTON_TEXTS), "css": list(BANNER_CSS)}
+CONSENT_COOKIE_PREFIX = "Optanon"  # OptanonConsent / OptanonAlertBoxClosed
+
+# Pages whose consent banner is already handled; skip the probe on later searches
+_DISMISSED_PAGES = weakref.WeakSet()
+
+# Returns a Playwright selector for the first visible consent button, or null
+FIND_BANNER_JS = """({texts, css}) => {
+  const visible = el => !!(el && (el.offsetWidth || el.offsetHeight || el.getClientRects().length));
+  const buttons = [...document.querySelectorAll('button')];
+  for (const t of texts) {
+    const b = buttons.find(b => (b.innerText || '').toLowerCase().includes(t.toLowerCase()));
+    if (visible(b)) return `button:has-text('${t}')`;
+  }
+  for (const s of css) {
+    if (visible(document.querySelector(s))) return s;
+  }
+  return null;
+}"""
+
+# Only anchor text/href is needed; skip page weight and third-party scripts (incl. OneTrust)
+BLOCK_ASSETS = os.getenv("BLOCK_ASSETS", "1") == "1"
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font", "stylesheet"})
+BLOCKED_HOSTS = (
+    "googletagmanager.com",
+    "google-analytics.com",
+    "doubleclick.net",
+    "cdn.cookielaw.org",
+    "onetrust.com",
+)
+
+_log = logging.getLogger("robot")
+
+def log(msg: str): _log.info(msg)
+
+_log_buffer = None
+
+def setup_logging(*names: str) -> None:
+    """Send the named loggers to stderr at LOG_LEVEL (INFO if unknown); the root logger is left alone.
+       Records are buffered and written in batches (on WARNING+, when full, and at interpreter
+       exit via logging.shutdown) instead of one flushed write per line."""
+    global _log_buffer
+    level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    if _log_buffer is None:
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter("[%(name)s] %(message)s"))
+        _log_buffer = logging.handlers.MemoryHandler(capacity=64, flushLevel=logging.WARNING, target=stream)
+    for name in names:
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        if _log_buffer not in logger.handlers:
+            logger.addHandler(_log_buffer)
+        logger.propagate = False
+
+# Minimal renderer: small backing store, no downloads or service workers
+CONTEXT_OPTIONS = dict(
+    viewport={"width": 800, "height": 600},
+    device_scale_factor=1,
+    has_touch=False,
+    java_script_enabled=True,
+    bypass_csp=False,
+    service_workers="block",
+    accept_downloads=False,
+    reduced_motion="reduce",
+)
+
+def _route_assets(route):
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCE_TYPES or any(h in req.url for h in BLOCKED_HOSTS):
+        route.abort()
+    else:
+        route.continue_()
+
+def _prepare_page(page):
+    if BLOCK_ASSETS:
+        page.route("**/*", _route_assets)
+        # The consent banner script never loads, so there is nothing to dismiss
+        _DISMISSED_PAGES.add(page)
+    return page
+
+@contextlib.contextmanager
+def open_page(p, headful: bool = False):
+    """Yield a page from a warm browser: an already-running Chromium over CDP when
+       CONNECT_OVER_CDP=1, else a persistent profile under CACHE_DIR so cookies,
+       HTTP cache and consent state survive between runs."""
+    if os.getenv("CONNECT_OVER_CDP", "0") == "1":
+        browser = p.chromium.connect_over_cdp(os.getenv("CDP_URL", "http://127.0.0.1:9222"))
+        # An existing daemon context keeps its own settings; only a fresh one gets CONTEXT_OPTIONS
+        ctx = browser.contexts[0] if browser.contexts else browser.new_context(**CONTEXT_OPTIONS)
+        page = _prepare_page(ctx.new_page())
+        try:
+            yield page
+        finally:
+            # Leave the daemon running; only drop our tab and the connection
+            with contextlib.suppress(Exception):
+                page.close()
+            with contextlib.suppress(Exception):
+                browser.close()
+        return
+
+    ctx = p.chromium.launch_persistent_context(
+        user_data_dir=os.path.join(CACHE_DIR, "profile"),
+        headless=not headful,
+        args=["--no-sandbox", f"--disk-cache-dir={os.path.join(CACHE_DIR, 'http')}"],
+        **CONTEXT_OPTIONS,
+    )
+    try:
+        yield _prepare_page(ctx.pages[0] if ctx.pages else ctx.new_page())
+    finally:
+        with contextlib.suppress(Exception):
+            ctx.close()
+
+def is_organic(text: str, href: str) -> bool:
+    """Reject empty anchors, navigational tabs and anything under /search."""
+    if not text or not href:
+        return False
+    if "/search" in href.lower():
+        return False
+    return not ALL_LA_RE.search(text)
+
+def first_organic_in_html(html: str):
+    """First organic (title, href) in serialized HTML, parsed with selectolax; no :visible filtering."""
+    tree = HTMLParser(html)
+    for sel, limit in ORGANIC_CANDIDATES:
+        for node in tree.css(sel)[:limit]:
+            text = " ".join(node.text().split())
+            href = (node.attributes.get("href") or "").strip()
+            if is_organic(text, href):
+                return text, href
+    return None
+
+def first_organic(page):
+    """First organic (title, href): one evaluate_all returns only the candidate anchors, not the whole DOM."""
+    if ORGANIC_SOURCE == "html":
+        return first_organic_in_html(page.content())
+    rows = page.locator(ORGANIC_UNION).evaluate_all(ORGANIC_ROWS_JS, ORGANIC_CANDIDATES)
+    # Stable sort keeps document order within each candidate selector
+    for _, text, href in sorted(rows, key=lambda row: row[0]):
+        if is_organic(text, href):
+            return text, href
+    return None
+
+# Only timeouts are transient; other Playwright errors (bad selector, detached page) fail fast
+retry_on_timeout = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(multiplier=0.1, max=2.0),
+    retry=retry_if_exception_type(PWTimeoutError),
+    reraise=True,
+)
+
+@retry_on_timeout
 def wait_click(page, selector=None, *, role=None, name=None, timeout=6000):
     if role:
         el = page.get_by_role(role, name=name) if name else page.get_by_role(role)
@@ -17,7 +247,7 @@ def wait_click(page, selector=None, *, role=None, name=None, timeout=6000):
         page.wait_for_selector(selector, timeout=timeout)
         page.click(selector, timeout=timeout)
 
-@retry(stop=stop_after_attempt(2), wait=wait_fixed(0.8))
+@retry_on_timeout
 def wait_fill(page, selector=None, text="", *, role=None, name=None, timeout=6000):
     if role:
         el = page.get_by_role(role, name=name) if name else page.get_by_role(role)
@@ -28,40 +258,41 @@ def wait_fill(page, selector=None, text="", *, role=None, name=None, timeout=600
         page.fill(selector, text, timeout=timeout)
 
 def dismiss_banners(page):
-    for sel in [
-        "button:has-text('Accept')",
-        "button:has-text('I Agree')",
-        "[aria-label*='Accept']",
-        "#onetrust-accept-btn-handler",
-        "[data-testid='cookie-accept']",
-    ]:
-        with contextlib.suppress(Exception):
-            if page.locator(sel).first.is_visible():
-                page.locator(sel).first.click(timeout=1500)
+    if page in _DISMISSED_PAGES:
+        return
+    # A persisted consent cookie means the banner will not show
+    with contextlib.suppress(PWError):
+        if any(c["name"].startswith(CONSENT_COOKIE_PREFIX) for c in page.context.cookies()):
+            _DISMISSED_PAGES.add(page)
+            return
+    # One evaluate probes every candidate instead of an is_visible() round trip each
+    try:
+        sel = page.evaluate(FIND_BANNER_JS, BANNER_PROBE_ARGS)
+        if sel:
+            page.locator(sel).first.click(timeout=1500)
+            _DISMISSED_PAGES.add(page)
+    except PWTimeoutError:
+        return
+    except PWError as e:
+        log(f"banner scan aborted: {e}")
 
-def wait_for_results_page(page):
-    with contextlib.suppress(Exception):
-        page.wait_for_url(re.compile(r".*lacity\.gov/.+search.*"), timeout=20000)
-    with contextlib.suppress(Exception):
-        page.wait_for_load_state("domcontentloaded", timeout=20000)
+def wait_for_results_page(page, timeout=10000):
+    # The predicate also checks the URL, so no separate wait_for_url / load-state pass
+    with contextlib.suppress(PWTimeoutError):
+        page.wait_for_function(RESULTS_READY_JS, arg=RESULTS_READY_SELECTORS, timeout=timeout, polling=100)
 
 def find_first_result(page):
-    selectors = [
-        "main article h3 a",
-        "main .search-results a",
-        "article h2 a",
-        "main a.search-result__link",
-        "main li a[href]:not([href^='#'])",
-    ]
-    for sel in selectors:
-        try:
-            page.wait_for_selector(sel, timeout=8000)
-            loc = page.locator(sel).first
-            if loc and loc.is_visible():
-                return loc
-        except Exception:
-            continue
-    return None
+    # One selector group: a single wait and a single enumeration instead of one per selector
+    try:
+        page.wait_for_selector(RESULT_UNION, timeout=8000)
+        locs = page.locator(RESULT_UNION)
+        idx = locs.evaluate_all(BEST_MATCH_JS, list(RESULT_SELECTORS))
+        return locs.nth(idx) if idx >= 0 else None
+    except PWTimeoutError:
+        return None
+    except PWError as e:
+        log(f"result scan aborted: {e}")
+        return None
 
 def core_search(page, query: str):
     """Search via UI when possible; fall back to direct /search/all-city?keys=... .
@@ -69,20 +300,12 @@ def core_search(page, query: str):
     dismiss_banners(page)
     used = "ui"
 
-    # Try to open + type into a real input
+    # Try to open + type into a real input; the button is optional, so a miss is not retried
     with contextlib.suppress(Exception):
-        wait_click(page, role="button", name=re.compile(r"^search$", re.I))
+        wait_click.retry_with(stop=stop_after_attempt(1))(page, role="button", name=SEARCH_BUTTON_NAME_RE)
 
     typed = False
-    for sel in [
-        "form[role='search'] input[type='search']",
-        "form[role='search'] input[name='keys']",
-        "form[role='search'] input[name='q']",
-        "input[type='search']",
-        "input[name='keys']",
-        "input[name='q']",
-        "input[aria-label*='Search' i]",
-    ]:
+    for sel in SEARCH_INPUT_SELECTORS:
         try:
             page.wait_for_selector(sel, timeout=2000)
             page.fill(sel, query, timeout=2000)
@@ -96,61 +319,17 @@ def core_search(page, query: str):
     else:
         # Deterministic direct route to results (avoid /search root to skip tab page)
         used = "direct"
-        page.goto(f"{BASE_URL}search/all-city?keys={query}", timeout=15000, wait_until="domcontentloaded")
-
-    # Wait for results page state
-    with contextlib.suppress(Exception):
-        page.wait_for_url(re.compile(r"lacity\.gov/.+search", re.I), timeout=10000)
-    with contextlib.suppress(Exception):
-        page.wait_for_load_state("domcontentloaded", timeout=8000)
+        page.goto(f"{BASE_URL}search/all-city?keys={query}", timeout=15000, wait_until="commit")
 
-    # Ensure a results container is present (Drupal + Google CSE patterns)
-    for sel in ["div.gsc-results", ".search-results", "main"]:
-        with contextlib.suppress(Exception):
-            page.wait_for_selector(sel, timeout=4000)
-            break
-
-    def first_organic():
-        candidates = [
-            "div.gsc-results .gsc-webResult a.gs-title",
-            "div.gsc-results .gs-title a",
-            ".search-results .search-result h3 a",
-            "main article h3 a",
-            "main h3 a[href]",
-        ]
-        for sel in candidates:
-            locs = page.locator(sel)
-            n = min(locs.count(), 20)
-            for i in range(n):
-                a = locs.nth(i)
-                text = (a.inner_text() or "").strip()
-                href = (a.get_attribute("href") or "").strip()
-                if not text or not href:
-                    continue
-                # Filter out navigational/tabs & anything under /search
-                if "/search" in href.lower():
-                    continue
-                if re.search(r"\bAll LA City Websites\b", text, re.I):
-                    continue
-                return text, href
-        # last resort: any non-/search link in main
-        locs = page.locator("main a[href]:not([href^='#'])")
-        n = min(locs.count(), 40)
-        for i in range(n):
-            a = locs.nth(i)
-            text = (a.inner_text() or "").strip()
-            href = (a.get_attribute("href") or "").strip()
-            if text and href and "/search" not in href.lower() and not re.search(r"\bAll LA City Websites\b", text, re.I):
-                return text, href
-        return None
+    # Wait for results page state (Drupal + Google CSE patterns), polled in-page
+    wait_for_results_page(page)
 
-    picked = first_organic()
+    picked = first_organic(page)
     if not picked:
         with contextlib.suppress(Exception):
             page.screenshot(path="core_search_last.png", full_page=True)
         return None, None, used
 
-    title, url = picked
-    if url.startswith("/"):
-        url = BASE_URL.rstrip("/") + url
-    return title, url, used
\ No newline at end of file
+    title, href = picked
+    # Resolve against the document the link came from, as the skill cache does with the fetched URL
+    return title, urljoin(page.url, href), used
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""Per-host search "skills": a plain HTTP GET + CSS pick that replaces a browser pass.
+
+A skill is learned after a successful Playwright run and stored in skills.json,
+keyed by host: {method, url_template, result_selector, title_selector}. Hosts whose
+results cannot be reproduced over plain HTTP get {unlearnable: <epoch>} instead, so
+browser runs stop paying a doomed GET until LEARN_RETRY_S has passed.
+"""
+from __future__ import annotations
+import os, json, time, contextlib
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import quote, urljoin, urlsplit, urlunsplit, parse_qsl
+import httpx
+from selectolax.parser import HTMLParser
+from app.robot_utils import log, is_organic, BASE_URL, CACHE_DIR, ORGANIC_SELECTORS
+
+SKILLS_PATH = os.getenv("SKILLS_PATH", os.path.join(CACHE_DIR, "skills.json"))
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+LEARN_RETRY_S = int(os.getenv("SKILL_LEARN_RETRY_S", "86400"))
+
+def load() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(SKILLS_PATH, encoding="utf-8") as f:
+            skills = json.load(f)
+        return skills if isinstance(skills, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save(skills: Dict[str, Dict[str, Any]]) -> None:
+    os.makedirs(os.path.dirname(SKILLS_PATH) or ".", exist_ok=True)
+    tmp = SKILLS_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(skills, f, indent=2, sort_keys=True)
+    os.replace(tmp, SKILLS_PATH)
+
+def _fetch(method: str, url: str) -> Tuple[str, HTMLParser]:
+    r = httpx.request(method, url, timeout=5, headers=HEADERS, follow_redirects=True)
+    r.raise_for_status()
+    return str(r.url), HTMLParser(r.text)
+
+def _pick(tree: HTMLParser, base: str, result_selector: str, title_selector: Optional[str] = None):
+    for node in tree.css(result_selector)[:20]:
+        title_node = node.css_first(title_selector) if title_selector else node
+        # Collapse whitespace like innerText; text(strip=True) glues sibling nodes together
+        text = " ".join(title_node.text().split()) if title_node else ""
+        href = (node.attributes.get("href") or "").strip()
+        if is_organic(text, href):
+            return text, urljoin(base, href)
+    return None
+
+def _template_for(url: str, query: str) -> Optional[str]:
+    """Turn a concrete results URL into a template by replacing the query param value with {q}."""
+    parts = urlsplit(url)
+    pairs = parse_qsl(parts.query, keep_blank_values=True)
+    if not any(v == query for _, v in pairs):
+        return None
+    qs = "&".join(f"{quote(k)}={{q}}" if v == query else f"{quote(k)}={quote(v)}" for k, v in pairs)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, qs, ""))
+
+def try_execute(query: str, base_url: str = BASE_URL):
+    """Run the cached skill for base_url's host. Returns (title, url, "skill") or None on miss."""
+    host = urlsplit(base_url).hostname
+    skills = load()
+    skill = skills.get(host)
+    if not skill or "unlearnable" in skill:
+        return None
+    try:
+        base, tree = _fetch(skill.get("method", "GET"), skill["url_template"].format(q=quote(query)))
+        picked = _pick(tree, base, skill["result_selector"], skill.get("title_selector"))
+    except Exception as e:
+        log(f"skill failed for {host} ({e.__class__.__name__}: {e})")
+        picked = None
+    if not picked:
+        # Stale skill: drop it so the browser run can relearn
+        skills.pop(host, None)
+        try:
+            save(skills)
+        except OSError as e:
+            log(f"stale skill not dropped ({e})")
+        return None
+    title, href = picked
+    return title, href, "skill"
+
+def learn(page_url: str, query: str, href: str, base_url: str = BASE_URL) -> None:
+    """Record a skill if the results page is reachable without a browser and yields the same first result.
+       Keyed on base_url's host, like try_execute, so redirects (e.g. to www.) still hit."""
+    host = urlsplit(base_url).hostname
+    skills = load()
+    failed_at = skills.get(host, {}).get("unlearnable")
+    if failed_at and time.time() - failed_at < LEARN_RETRY_S:
+        return
+    try:
+        template = _template_for(page_url, query)
+        if not template:
+            return
+        base, tree = _fetch("GET", template.format(q=quote(query)))
+        for sel in ORGANIC_SELECTORS:
+            picked = _pick(tree, base, sel)
+            if picked and picked[1].rstrip("/") == href.rstrip("/"):
+                skills[host] = {
+                    "method": "GET",
+                    "url_template": template,
+                    "result_selector": sel,
+                    "title_selector": None,
+                }
+                save(skills)
+                log(f"learned skill: {template} -> {sel}")
+                return
+        # Results only exist after JS runs; remember that instead of re-fetching every run
+        log(f"skill not learned: {host} results need a browser")
+    except Exception as e:
+        log(f"skill not learned ({e.__class__.__name__}: {e})")
+    with contextlib.suppress(OSError):
+        skills[host] = {"unlearnable": time.time()}
+        save(skills)